@@ -2,17 +2,30 @@
 # SECTION 1: IMPORTS AND SETUP
 # ============================================================================
 import os
+import asyncio
+import base64
+import gc
+import hashlib
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+import numpy as np
 import pandas as pd
 import sys
 import time
-import mimetypes
 from datetime import datetime
 from PIL import Image
-from io import BytesIO
+from io import BytesIO, StringIO
 from IPython.display import display, Markdown, HTML
 import streamlit as st
+from streamlit import runtime
 print("✅ Standard libraries imported")
 
+# True under `streamlit run`; False in notebooks, where IPython display is used
+IS_STREAMLIT = runtime.exists()
+
 # Import Google Gemini
 from google import genai
 from google.genai import types
@@ -52,25 +65,79 @@ print("\n" + "=" * 80)
 print("🚀 INITIALIZING CLIENT")
 print("=" * 80)
 
-# Initialize the client
-client = genai.Client(api_key=GOOGLE_API_KEY)
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """Start the background event loop that runs every client.aio call.
+    
+    client.aio keeps its HTTP connection pool on the loop it first ran on, so
+    reusing one long-lived loop (rather than a fresh asyncio.run per call)
+    lets requests share pooled TLS/HTTP2 connections.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="gemini-aio", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and wait for its result (sync wrapper)"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+# Initialize the client once per process; Streamlit reruns reuse the cached instance
+@st.cache_resource(show_spinner=False)
+def get_client(loop_id):
+    """Create the Gemini client shared across sessions and reruns.
+    
+    The client is cached per event loop (loop_id is id(get_event_loop())): its
+    async connection pool must only ever be used from that loop, through
+    run_async, so a recreated loop always gets a fresh client.
+    
+    With GEMINI_SELFTEST=1 the client is tested once per process, here, rather
+    than on every rerun; otherwise misconfiguration surfaces on first use.
+    """
+    new_client = genai.Client(
+        api_key=GOOGLE_API_KEY,
+        http_options=types.HttpOptions(timeout=60_000)
+    )
+    
+    if os.getenv("GEMINI_SELFTEST") == "1":
+        try:
+            test_response = new_client.models.generate_content(
+                model=MODEL_TEXT,
+                contents="Say 'OK' if you're working"
+            )
+            print(f"✅ Test response: {test_response.text}")
+            print("✅ Client test successful!")
+        except Exception as e:
+            print(f"❌ Client test failed: {e}")
+    
+    return new_client
+
 MODEL_ID = "gemini-2.5-flash-image-preview"
 MODEL_TEXT = "gemini-2.5-flash"
+client = get_client(id(get_event_loop()))
+
+# google-genai releases without the async surface fall back to a thread pool
+HAS_AIO = hasattr(client, "aio")
 
 print(f"✅ Client initialized")
 print(f"📷 Image Model: {MODEL_ID}")
 print(f"📝 Text Model: {MODEL_TEXT}")
 
-# Test the client
-try:
-    test_response = client.models.generate_content(
-        model=MODEL_TEXT,
-        contents="Say 'OK' if you're working"
-    )
-    print(f"✅ Test response: {test_response.text}")
-    print("✅ Client test successful!")
-except Exception as e:
-    print(f"❌ Client test failed: {e}")
+# Service tiers only exist in newer google-genai releases; older ones use the standard tier
+HAS_SERVICE_TIERS = hasattr(types, "ServiceTier")
+if not HAS_SERVICE_TIERS:
+    print("⚠️ Installed google-genai has no service tiers; Priority/Flex requests use the standard tier. "
+          "Upgrade google-genai to enable them.")
+
+def tiered_config(service_tier=None, **kwargs):
+    """Build a GenerateContentConfig on the given service tier ("PRIORITY" or "FLEX").
+    
+    PRIORITY trades price for lower latency on user-facing calls, FLEX trades
+    latency for price on bulk work. Without HAS_SERVICE_TIERS the tier is
+    ignored and the call runs on the standard tier.
+    """
+    if service_tier and HAS_SERVICE_TIERS:
+        kwargs["service_tier"] = getattr(types.ServiceTier, service_tier)
+    return types.GenerateContentConfig(**kwargs)
 
 # ============================================================================
 # SECTION 4: HELPER FUNCTIONS (Based on Working Example)
@@ -80,6 +147,9 @@ print("\n" + "=" * 80)
 print("🛠️ SETTING UP HELPER FUNCTIONS")
 print("=" * 80)
 
+# Gemini only returns these image types, so skip the mimetypes registry
+IMAGE_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+
 def save_binary_file(file_name, data):
     """Save binary data to file"""
     with open(file_name, "wb") as f:
@@ -87,39 +157,71 @@ def save_binary_file(file_name, data):
     print(f"💾 File saved to: {file_name}")
     return file_name
 
+def thumbnail_png(image_bytes, size=(400, 400)):
+    """Downscale an image to fit within size and re-encode it as a compact PNG buffer"""
+    image = Image.open(BytesIO(image_bytes))
+    image.thumbnail(size, Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", optimize=True, compress_level=9)
+    buffer.seek(0)
+    return buffer
+
+def _iter_parts(response):
+    """Yield every part of a response, from its candidates or its direct parts"""
+    # Handle candidates structure
+    candidates = getattr(response, 'candidates', None)
+    if candidates:
+        for candidate in candidates:
+            yield from getattr(getattr(candidate, 'content', None), 'parts', None) or ()
+    # Handle direct parts structure
+    else:
+        yield from getattr(response, 'parts', None) or ()
+
+def _inline_image_data(part):
+    """Return the inline image bytes of a part, or None if it carries no image"""
+    return getattr(getattr(part, 'inline_data', None), 'data', None)
+
 def display_response(response):
     """Display text and images from response"""
     if not response:
         print("⚠️ No response to display")
         return
     
-    # Handle candidates structure
-    if hasattr(response, 'candidates') and response.candidates:
-        for candidate in response.candidates:
-            if hasattr(candidate, 'content') and candidate.content:
-                if hasattr(candidate.content, 'parts'):
-                    for part in candidate.content.parts:
-                        process_part(part)
-    # Handle direct parts structure
-    elif hasattr(response, 'parts'):
-        for part in response.parts:
-            process_part(part)
+    texts = []
+    for part in _iter_parts(response):
+        process_part(part, texts)
+    
+    # Under Streamlit, render all of the response text in one call
+    if texts:
+        st.markdown("\n\n".join(texts))
 
-def process_part(part):
-    """Process a single part (text or image)"""
+def process_part(part, texts=None):
+    """Process a single part (text or image).
+    
+    Under Streamlit, text is collected into `texts` when given, so the caller
+    can render it at once, and images go straight to st.image.
+    """
     # Display text
     if hasattr(part, 'text') and part.text:
-        display(Markdown(part.text))
+        if not IS_STREAMLIT:
+            display(Markdown(part.text))
+        elif texts is not None:
+            texts.append(part.text)
+        else:
+            st.markdown(part.text)
     
     # Display image
-    if hasattr(part, 'inline_data') and part.inline_data:
-        if hasattr(part.inline_data, 'data') and part.inline_data.data:
-            try:
-                image = Image.open(BytesIO(part.inline_data.data))
-                print(f"📷 Image: {image.size[0]}x{image.size[1]} pixels")
-                display(image)
-            except Exception as e:
-                print(f"⚠️ Could not display image: {e}")
+    data = _inline_image_data(part)
+    if data:
+        if IS_STREAMLIT:
+            st.image(data)
+            return
+        try:
+            image = Image.open(BytesIO(data))
+            print(f"📷 Image: {image.size[0]}x{image.size[1]} pixels")
+            display(image)
+        except Exception as e:
+            print(f"⚠️ Could not display image: {e}")
 
 def extract_and_save_images(response, prefix="image"):
     """Extract and save all images from response"""
@@ -128,32 +230,17 @@ def extract_and_save_images(response, prefix="image"):
     if not response:
         return saved_files
     
-    # Handle candidates structure
-    if hasattr(response, 'candidates') and response.candidates:
-        for candidate in response.candidates:
-            if hasattr(candidate, 'content') and candidate.content:
-                if hasattr(candidate.content, 'parts'):
-                    for i, part in enumerate(candidate.content.parts):
-                        if hasattr(part, 'inline_data') and part.inline_data:
-                            if hasattr(part.inline_data, 'data') and part.inline_data.data:
-                                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                mime_type = getattr(part.inline_data, 'mime_type', 'image/png')
-                                ext = mimetypes.guess_extension(mime_type) or '.png'
-                                filename = f"{prefix}_{timestamp}_{i}{ext}"
-                                save_binary_file(filename, part.inline_data.data)
-                                saved_files.append(filename)
+    # One timestamp per response, shared by all of its image parts
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
-    # Handle direct parts structure
-    elif hasattr(response, 'parts'):
-        for i, part in enumerate(response.parts):
-            if hasattr(part, 'inline_data') and part.inline_data:
-                if hasattr(part.inline_data, 'data') and part.inline_data.data:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    mime_type = getattr(part.inline_data, 'mime_type', 'image/png')
-                    ext = mimetypes.guess_extension(mime_type) or '.png'
-                    filename = f"{prefix}_{timestamp}_{i}{ext}"
-                    save_binary_file(filename, part.inline_data.data)
-                    saved_files.append(filename)
+    for i, part in enumerate(_iter_parts(response)):
+        data = _inline_image_data(part)
+        if data:
+            mime_type = getattr(part.inline_data, 'mime_type', 'image/png')
+            ext = IMAGE_EXTENSIONS.get(mime_type, '.png')
+            filename = f"{prefix}_{timestamp}_{i}{ext}"
+            save_binary_file(filename, data)
+            saved_files.append(filename)
     
     return saved_files
 
@@ -182,7 +269,8 @@ def generate_image_basic(prompt):
         
         if response:
             print("✅ Response received!")
-            display_response(response)
+            if not IS_STREAMLIT:
+                display_response(response)
             saved_files = extract_and_save_images(response, "basic")
             return saved_files
         else:
@@ -241,21 +329,14 @@ def generate_image_streaming(prompt, save_prefix="stream"):
                 # Handle image
                 if part.inline_data and part.inline_data.data:
                     mime_type = getattr(part.inline_data, 'mime_type', 'image/png')
-                    ext = mimetypes.guess_extension(mime_type) or '.png'
+                    ext = IMAGE_EXTENSIONS.get(mime_type, '.png')
                     filename = f"{save_prefix}_{file_index}{ext}"
                     save_binary_file(filename, part.inline_data.data)
                     saved_files.append(filename)
                     file_index += 1
-                    
-                    # Display the image
-                    try:
-                        image = Image.open(BytesIO(part.inline_data.data))
-                        print(f"\n📷 Image generated: {image.size[0]}x{image.size[1]}")
-                        display(image)
-                    except:
-                        pass
         
-        print(f"\n✅ Streaming complete! Generated {len(saved_files)} image(s)")
+        # Callers display the saved files themselves, so no per-chunk decode here
+        print(f"\n✅ Streaming complete! Generated {len(saved_files)} image(s): {', '.join(saved_files)}")
         return saved_files
         
     except Exception as e:
@@ -263,7 +344,515 @@ def generate_image_streaming(prompt, save_prefix="stream"):
         return saved_files
 
 # ============================================================================
-# SECTION 7: STREAMLIT UI INTEGRATION WITH STEP-BY-STEP FEATURES
+# SECTION 7: CONCURRENT IMAGE GENERATION (ASYNC FAN-OUT)
+# ============================================================================
+
+print("\n" + "=" * 80)
+print("⚡ DEMO 3: CONCURRENT IMAGE GENERATION")
+print("=" * 80)
+
+# Upper bound on in-flight Gemini requests, to stay within rate limits
+MAX_CONCURRENCY = 8
+
+def _image_request(prompt, service_tier=None):
+    """Build the contents and config for one streaming image request"""
+    contents = [
+        types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=prompt)],
+        )
+    ]
+    
+    config = tiered_config(
+        service_tier,
+        response_modalities=["IMAGE", "TEXT"]
+    )
+    return contents, config
+
+def _chunk_images(chunk):
+    """Return the (bytes, mime_type) images carried by one streamed chunk"""
+    if (chunk.candidates is None or 
+        chunk.candidates[0].content is None or 
+        chunk.candidates[0].content.parts is None):
+        return []
+    
+    return [
+        (part.inline_data.data, getattr(part.inline_data, 'mime_type', 'image/png'))
+        for part in chunk.candidates[0].content.parts
+        if part.inline_data and part.inline_data.data
+    ]
+
+async def generate_image_streaming_async(prompt, key="stream", service_tier=None):
+    """Generate image using the async streaming API (client.aio).
+    
+    Images are kept in memory and returned as (bytes, mime_type) tuples.
+    """
+    print(f"\n📝 Prompt: {prompt[:100]}...")
+    images = []
+    contents, config = _image_request(prompt, service_tier)
+    
+    stream = await client.aio.models.generate_content_stream(
+        model=MODEL_ID,
+        contents=contents,
+        config=config,
+    )
+    
+    async for chunk in stream:
+        images.extend(_chunk_images(chunk))
+    
+    print(f"\n✅ {key}: generated {len(images)} image(s)")
+    return images
+
+def generate_image_streaming_blocking(prompt, key="stream", service_tier=None):
+    """Blocking counterpart of generate_image_streaming_async, for SDKs without client.aio"""
+    print(f"\n📝 Prompt: {prompt[:100]}...")
+    images = []
+    contents, config = _image_request(prompt, service_tier)
+    
+    for chunk in client.models.generate_content_stream(
+        model=MODEL_ID,
+        contents=contents,
+        config=config,
+    ):
+        images.extend(_chunk_images(chunk))
+    
+    print(f"\n✅ {key}: generated {len(images)} image(s)")
+    return images
+
+def _collect_as_completed(futures, on_progress=None):
+    """Collect {future: index} results in index order, as each future finishes.
+    
+    Exceptions are returned in place of results. on_progress(done, total) is
+    called after every completion, in the calling thread.
+    """
+    results = [None] * len(futures)
+    for done, future in enumerate(as_completed(futures), 1):
+        i = futures[future]
+        try:
+            results[i] = future.result()
+        except Exception as e:
+            results[i] = e
+        if on_progress:
+            on_progress(done, len(futures))
+    return results
+
+def generate_images_threaded(prompts, max_workers=MAX_CONCURRENCY, service_tier=None, on_progress=None):
+    """Thread pool fan-out with the same result shape as generate_images_concurrently.
+    
+    Threads overlap well here because the GIL is released while waiting on the network.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(generate_image_streaming_blocking, prompt, key, service_tier): i
+            for i, (prompt, key) in enumerate(prompts)
+        }
+        return _collect_as_completed(futures, on_progress)
+
+async def _generate_with_limit(semaphore, prompt, key, service_tier=None):
+    """Run one streaming request once the semaphore admits it"""
+    async with semaphore:
+        return await generate_image_streaming_async(prompt, key, service_tier)
+
+def generate_images_concurrently(prompts, max_concurrency=MAX_CONCURRENCY, service_tier=None, on_progress=None):
+    """Generate images for a list of (prompt, key) pairs concurrently.
+    
+    Returns one entry per prompt, in order: the list of (bytes, mime_type)
+    images, or the exception raised for that prompt. on_progress(done, total)
+    is called as each prompt finishes, in completion order.
+    """
+    print(f"\n🚀 Generating {len(prompts)} image(s), up to {max_concurrency} at a time")
+    if not HAS_AIO:
+        return generate_images_threaded(prompts, max_concurrency, service_tier, on_progress)
+    
+    # Each request is its own future on the shared loop, so results can be reported as they land
+    semaphore = asyncio.Semaphore(max_concurrency)
+    loop = get_event_loop()
+    futures = {
+        asyncio.run_coroutine_threadsafe(_generate_with_limit(semaphore, prompt, key, service_tier), loop): i
+        for i, (prompt, key) in enumerate(prompts)
+    }
+    return _collect_as_completed(futures, on_progress)
+
+# ============================================================================
+# SECTION 8: BATCH IMAGE GENERATION (BULK / OFFLINE)
+# ============================================================================
+
+print("\n" + "=" * 80)
+print("📦 DEMO 4: BATCH IMAGE GENERATION")
+print("=" * 80)
+
+BATCH_SUCCESS_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+}
+BATCH_TERMINAL_STATES = BATCH_SUCCESS_STATES | {
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+def _wait_for_batch(job, poll_interval, max_poll_interval, max_wait):
+    """Poll a batch job with exponential backoff until it finishes or max_wait seconds pass"""
+    deadline = time.monotonic() + max_wait
+    delay = poll_interval
+    while job.state.name not in BATCH_TERMINAL_STATES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            try:
+                client.batches.cancel(name=job.name)
+            except Exception as e:
+                print(f"⚠️ Could not cancel batch job {job.name}: {e}")
+            raise TimeoutError(f"Batch job {job.name} still {job.state.name} after {max_wait} s; cancelled")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_poll_interval)
+        job = client.batches.get(name=job.name)
+        print(f"⏳ Batch job state: {job.state.name}")
+    return job
+
+def generate_images_batch(prompts, display_name="memes", poll_interval=10, max_poll_interval=120, max_wait=1800):
+    """Generate images for a list of (prompt, key) pairs via the Batch API.
+    
+    Batch jobs are billed at half the standard price and are not subject to
+    per-request rate limits, at the cost of minutes (not seconds) of turnaround.
+    Raises TimeoutError (after cancelling the job) if it has not finished
+    within max_wait seconds. Returns the same shape as generate_images_concurrently.
+    """
+    print(f"\n📦 Submitting batch of {len(prompts)} request(s)")
+    
+    # One JSONL request per prompt, keyed by its key, in a file private to this job
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", encoding="utf-8", delete=False) as f:
+        requests_file = f.name
+        for prompt, key in prompts:
+            request = {
+                "key": key,
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                    "generationConfig": {"responseModalities": ["IMAGE", "TEXT"]},
+                },
+            }
+            f.write(json.dumps(request) + "\n")
+    
+    try:
+        uploaded = client.files.upload(
+            file=requests_file,
+            config=types.UploadFileConfig(display_name=display_name, mime_type="jsonl"),
+        )
+    finally:
+        os.remove(requests_file)
+    
+    try:
+        job = client.batches.create(
+            model=MODEL_ID,
+            src=uploaded.name,
+            config=types.CreateBatchJobConfig(display_name=display_name),
+        )
+        print(f"✅ Batch job created: {job.name}")
+        job = _wait_for_batch(job, poll_interval, max_poll_interval, max_wait)
+    finally:
+        # The input file is only needed while the job runs
+        try:
+            client.files.delete(name=uploaded.name)
+        except Exception as e:
+            print(f"⚠️ Could not delete batch input file {uploaded.name}: {e}")
+    
+    if job.state.name not in BATCH_SUCCESS_STATES:
+        raise RuntimeError(f"Batch job {job.name} finished with state {job.state.name}")
+    
+    output = client.files.download(file=job.dest.file_name)
+    results = {}
+    for line in output.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        key = entry.get("key")
+        if entry.get("error"):
+            results[key] = RuntimeError(entry["error"])
+            continue
+        
+        images = []
+        for candidate in entry.get("response", {}).get("candidates", []):
+            for part in candidate.get("content", {}).get("parts", []):
+                inline_data = part.get("inlineData")
+                if inline_data and inline_data.get("data"):
+                    mime_type = inline_data.get("mimeType", "image/png")
+                    images.append((base64.b64decode(inline_data["data"]), mime_type))
+        results[key] = images
+    
+    print(f"✅ Batch complete! {len(results)} response(s) received")
+    return [
+        results.get(key, RuntimeError(f"No batch response for {key}"))
+        for _, key in prompts
+    ]
+
+# ============================================================================
+# SECTION 9: CACHED GENERATION (SHARED ACROSS STREAMLIT RERUNS)
+# ============================================================================
+
+MARKETING_COLUMNS = ['meme_template', 'prompt', 'company_background', 'marketing_message', 'call_to_action', 'target_audience', 'platform', 'theme']
+
+@dataclass(slots=True)
+class MemeRecord:
+    """One generated meme with its marketing data row, as kept in session_state"""
+    row: int
+    image_bytes: bytes
+    mime_type: str
+    meme_prompt: str
+    meme_template: str
+    prompt: str
+    company_background: str
+    marketing_message: str
+    call_to_action: str
+    target_audience: str
+    platform: str
+    theme: str
+
+# Meme image prompt, filled from one marketing data row with str.format_map
+MEME_PROMPT_TEMPLATE = """
+"Create a meme using the '{meme_template}' style.
+The meme should tell a short, funny, and relatable story targeting {target_audience} on {platform}.
+
+Company Background : Complytics.ai, {company_background}
+Marketing Message : {marketing_message}
+Call to Action to use Complytics.ai : {call_to_action}
+
+Theme: {theme}
+
+Ensure the meme humor connects with the target audience while subtly highlighting the value of the company.
+The final meme should be engaging, visually clear, and suitable for viral social media marketing.
+Avoid adding any company logo. Dont make spelling mistake"
+""".strip()
+
+EMBEDDING_MODEL = "text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = 3600
+# Total image bytes the exact cache may hold across all sessions
+EXACT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+class PromptCache:
+    """Process-wide cache of Gemini responses, keyed on the prompt.
+    
+    Exact entries are looked up by a hash of the whitespace-normalized prompt
+    (used for images, which are expensive to regenerate). Semantic entries are
+    looked up by an exact cache_key plus cosine similarity of embeddings (used
+    for text, so a reworded business description still hits), and expire
+    after semantic_ttl seconds.
+    """
+    
+    def __init__(self, max_entries=256, semantic_ttl=SEMANTIC_CACHE_TTL, max_similar_per_key=8,
+                 max_exact_bytes=EXACT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_exact_bytes = max_exact_bytes
+        self.semantic_ttl = semantic_ttl
+        self.max_similar_per_key = max_similar_per_key
+        self._lock = threading.Lock()
+        self._exact = {}
+        self._exact_bytes = 0
+        # cache_key -> [(embedding, text, stored_at), ...]
+        self._similar = {}
+    
+    @staticmethod
+    def _key(prompt):
+        return hashlib.sha256(" ".join(prompt.split()).encode("utf-8")).hexdigest()
+    
+    def get_exact(self, prompt):
+        with self._lock:
+            return self._exact.get(self._key(prompt))
+    
+    @staticmethod
+    def _size(value):
+        return sum(len(data) for data, _ in value)
+    
+    def put_exact(self, prompt, value):
+        """Cache a list of (bytes, mime_type) images, evicting the oldest entries past the limits"""
+        if self._size(value) > self.max_exact_bytes:
+            return
+        with self._lock:
+            key = self._key(prompt)
+            if key in self._exact:
+                self._exact_bytes -= self._size(self._exact.pop(key))
+            self._exact[key] = value
+            self._exact_bytes += self._size(value)
+            # Dicts keep insertion order, so the first key is the oldest entry
+            while len(self._exact) > self.max_entries or self._exact_bytes > self.max_exact_bytes:
+                self._exact_bytes -= self._size(self._exact.pop(next(iter(self._exact))))
+    
+    def evict_exact(self, prompts):
+        """Drop the cached images for the given prompts"""
+        with self._lock:
+            for prompt in prompts:
+                value = self._exact.pop(self._key(prompt), None)
+                if value is not None:
+                    self._exact_bytes -= self._size(value)
+    
+    def get_similar(self, cache_key, embedding, threshold=SEMANTIC_CACHE_THRESHOLD):
+        with self._lock:
+            cutoff = time.monotonic() - self.semantic_ttl
+            entries = [entry for entry in self._similar.get(cache_key, []) if entry[2] >= cutoff]
+            if not entries:
+                self._similar.pop(cache_key, None)
+                return None
+            self._similar[cache_key] = entries
+            scores = np.stack([entry[0] for entry in entries]) @ embedding
+            best = int(np.argmax(scores))
+            return entries[best][1] if scores[best] >= threshold else None
+    
+    def put_similar(self, cache_key, embedding, text):
+        with self._lock:
+            entries = self._similar.pop(cache_key, [])
+            entries.append((embedding, text, time.monotonic()))
+            # Re-insert so the most recently written key is last, then evict the oldest keys
+            self._similar[cache_key] = entries[-self.max_similar_per_key:]
+            while len(self._similar) > self.max_entries:
+                del self._similar[next(iter(self._similar))]
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_cache():
+    """Create the prompt cache shared across sessions and reruns"""
+    return PromptCache()
+
+prompt_cache = get_prompt_cache()
+
+async def embed_prompt(prompt):
+    """Embed a prompt as a unit vector, so a dot product is its cosine similarity"""
+    if HAS_AIO:
+        result = await client.aio.models.embed_content(model=EMBEDDING_MODEL, contents=prompt)
+    else:
+        result = await asyncio.to_thread(client.models.embed_content, model=EMBEDDING_MODEL, contents=prompt)
+    embedding = np.asarray(result.embeddings[0].values, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+async def llm_call(prompt, model, config=None, parse=str, cache_key="", similarity_text=None, use_cache=True):
+    """Generate text for a prompt and return parse(text), using the semantic cache.
+    
+    A cached response is reused when an entry under the same cache_key has a
+    similarity_text close enough to this one. Responses are only cached after
+    parse() accepts them, so a malformed response is never replayed. If the
+    embedding call fails, the request goes to Gemini uncached. use_cache=False
+    skips the lookup but still caches the fresh response.
+    """
+    embedding = None
+    if similarity_text is not None:
+        try:
+            embedding = await embed_prompt(similarity_text)
+        except Exception as e:
+            print(f"⚠️ Embedding failed, skipping the semantic cache: {e}")
+    
+    if use_cache and embedding is not None:
+        cached_text = prompt_cache.get_similar(cache_key, embedding)
+        if cached_text is not None:
+            print("♻️ Semantic cache hit")
+            return parse(cached_text)
+    
+    if HAS_AIO:
+        response = await client.aio.models.generate_content(model=model, contents=prompt, config=config)
+    else:
+        response = await asyncio.to_thread(client.models.generate_content, model=model, contents=prompt, config=config)
+    result = parse(response.text)
+    if embedding is not None:
+        prompt_cache.put_similar(cache_key, embedding, response.text)
+    return result
+
+MARKETING_ROWS = 10
+# Fewer usable rows than this is treated as a failed generation (and never cached)
+MIN_MARKETING_ROWS = MARKETING_ROWS // 2
+# Rows missing any of these are unusable as meme prompts
+REQUIRED_MARKETING_COLUMNS = ['meme_template', 'marketing_message']
+
+def parse_marketing_csv(text):
+    """Parse Gemini's CSV response into a DataFrame, raising ValueError if too few rows survive"""
+    # Drop Markdown code fences (```csv ... ```) the model sometimes wraps the CSV in
+    lines = [line for line in text.strip().splitlines() if not line.lstrip().startswith("```")]
+    
+    # All columns are text, so skip type inference, and drop malformed rows
+    # (e.g. a stray comma from the LLM) instead of failing outright
+    marketing_data = pd.read_csv(
+        StringIO("\n".join(lines)),
+        header=None,
+        names=MARKETING_COLUMNS,
+        engine="c",
+        dtype=str,
+        na_filter=False,
+        keep_default_na=False,
+        on_bad_lines="skip",
+    )
+    
+    # Short rows are padded with empty strings rather than skipped, so filter them out here
+    required = marketing_data[REQUIRED_MARKETING_COLUMNS].fillna("")
+    usable = (required.apply(lambda column: column.str.strip()) != "").all(axis=1)
+    marketing_data = marketing_data[usable].reset_index(drop=True)
+    if len(marketing_data) < MIN_MARKETING_ROWS:
+        raise ValueError(f"Only {len(marketing_data)} usable row(s) in the generated CSV; please regenerate")
+    return marketing_data
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def generate_marketing_csv(name, website, about, _use_cache=True):
+    """Generate marketing ideas for a business as a DataFrame, cached on the business info.
+    
+    Besides this exact cache, the semantic cache reuses a response for the same
+    name and website when the description is phrased only slightly differently.
+    To force a fresh Gemini call, clear this business's entry with
+    generate_marketing_csv.clear(name, website, about) and pass _use_cache=False.
+    """
+    csv_prompt = f"""
+    Based on the following business details:
+    - Business Name: {name}
+    - Website: {website}
+    - About: {about}
+    
+    Generate {MARKETING_ROWS} rows of marketing data in CSV format with columns: meme_template, prompt, company_background, marketing_message, call_to_action, target_audience, platform, theme.
+    Each row should be a unique meme idea tailored to the business.
+    Output only the CSV data without headers or extra text.
+    """
+    
+    # Only the description is compared semantically; name and website must match exactly,
+    # so a similar business never receives another company's CSV
+    cache_key = "\n".join(field.strip().lower() for field in (name, website))
+    return run_async(llm_call(
+        csv_prompt,
+        MODEL_TEXT,
+        tiered_config("PRIORITY"),
+        parse=parse_marketing_csv,
+        cache_key=cache_key,
+        similarity_text=about,
+        use_cache=_use_cache,
+    ))
+
+def generate_memes(prompts, use_batch=False, service_tier=None, on_progress=None):
+    """Generate memes for a list of (prompt, key) pairs, cached per prompt.
+    
+    Returns one entry per prompt: the list of (bytes, mime_type) images, or the
+    exception raised for that prompt. Prompts already in the exact prompt cache
+    are not resent, and only successful results are cached, so a retry reaches
+    Gemini again for failed rows. on_progress(done, total) counts cache hits
+    as already done.
+    """
+    results = [prompt_cache.get_exact(prompt) for prompt, _ in prompts]
+    misses = [pair for pair, result in zip(prompts, results) if result is None]
+    hits = len(prompts) - len(misses)
+    if on_progress:
+        on_progress(hits, len(prompts))
+    if not misses:
+        return results
+    
+    if use_batch and len(misses) > 1:
+        try:
+            generated = generate_images_batch(misses)
+        except Exception as e:
+            generated = [e] * len(misses)
+    else:
+        report = (lambda done, _: on_progress(hits + done, len(prompts))) if on_progress else None
+        generated = generate_images_concurrently(misses, service_tier=service_tier, on_progress=report)
+    
+    generated = iter(generated)
+    for i, (prompt, _) in enumerate(prompts):
+        if results[i] is None:
+            results[i] = next(generated)
+            if results[i] and not isinstance(results[i], Exception):
+                prompt_cache.put_exact(prompt, results[i])
+    return results
+
+# ============================================================================
+# SECTION 10: STREAMLIT UI INTEGRATION WITH STEP-BY-STEP FEATURES
 # ============================================================================
 
 # Streamlit page config
@@ -304,40 +893,31 @@ with tab2:
         st.warning("Please complete Step 1 first.")
     else:
         info = st.session_state.business_info
+        reuse_cached = st.checkbox(
+            "Reuse cached results",
+            value=True,
+            help="Uncheck to ask Gemini for fresh marketing data instead of a cached result for this business.",
+        )
         generate_csv_btn = st.button("Generate Marketing Data CSV")
         
         if generate_csv_btn:
             with st.spinner("Generating marketing data using AI..."):
-                # Use Gemini to generate CSV data
-                csv_prompt = f"""
-                Based on the following business details:
-                - Business Name: {info['name']}
-                - Website: {info['website']}
-                - About: {info['about']}
-                
-                Generate 10 rows of marketing data in CSV format with columns: meme_template, prompt, company_background, marketing_message, call_to_action, target_audience, platform, theme.
-                Each row should be a unique meme idea tailored to the business.
-                Output only the CSV data without headers or extra text.
-                """
-                
                 try:
-                    response = client.models.generate_content(
-                        model=MODEL_TEXT,
-                        contents=csv_prompt
+                    # Use Gemini to generate CSV data (cached on the business info)
+                    if not reuse_cached:
+                        # Drop only this business's entry; other sessions keep their cached CSVs
+                        generate_marketing_csv.clear(info['name'], info['website'], info['about'])
+                    marketing_data = generate_marketing_csv(
+                        info['name'], info['website'], info['about'], _use_cache=reuse_cached
                     )
-                    csv_content = response.text.strip()
-                    
-                    # Parse CSV content into DataFrame
-                    from io import StringIO
-                    marketing_data = pd.read_csv(StringIO(csv_content), header=None, names=['meme_template', 'prompt', 'company_background', 'marketing_message', 'call_to_action', 'target_audience', 'platform', 'theme'])
                     
                     st.session_state.marketing_data = marketing_data
                     st.success("✅ Marketing data generated!")
                     st.dataframe(marketing_data)
                     
-                    # Save CSV
-                    marketing_data.to_csv("generated_marketing_data.csv", index=False)
-                    st.download_button("Download CSV", data=marketing_data.to_csv(index=False), file_name="generated_marketing_data.csv", mime="text/csv")
+                    # Serialize once, in memory, for the download button
+                    csv_bytes = marketing_data.to_csv(index=False).encode()
+                    st.download_button("Download CSV", data=csv_bytes, file_name="generated_marketing_data.csv", mime="text/csv")
                 except Exception as e:
                     st.error(f"❌ Failed to generate CSV: {e}")
 
@@ -348,84 +928,97 @@ with tab3:
     else:
         marketing_data = st.session_state.marketing_data
         
-        # Select rows to generate memes
-        options_list = ["Select All"] + [f"Row {i}: {marketing_data.iloc[i]['meme_template']}" for i in range(len(marketing_data))]
-        selected_options = st.multiselect("Select rows to generate memes", options=options_list)
+        # Select rows to generate memes; options are row indices, with -1 for "Select All"
+        templates = marketing_data['meme_template'].tolist()
+        options_list = [-1] + list(range(len(templates)))
+        selected_options = st.multiselect(
+            "Select rows to generate memes",
+            options=options_list,
+            format_func=lambda i: "Select All" if i < 0 else f"Row {i}: {templates[i]}",
+        )
         
-        if "Select All" in selected_options:
-            selected_indices = list(range(len(marketing_data)))
+        if -1 in selected_options:
+            selected_indices = list(range(len(templates)))
         else:
-            selected_indices = [int(opt.split(":")[0].replace("Row ", "")) for opt in selected_options if opt != "Select All"]
+            selected_indices = [i for i in selected_options if i >= 0]
         
+        use_batch = st.checkbox(
+            "Use Batch API",
+            help="Half the cost and no per-request rate limits, but jobs can take minutes to complete. "
+                 "A single selected row always uses the faster streaming path.",
+        )
+        # Batch jobs have their own pricing, so the tier choice only applies to streaming
+        interactive = True
+        if not use_batch:
+            interactive = st.checkbox(
+                "Interactive",
+                value=True,
+                disabled=not HAS_SERVICE_TIERS,
+                help="Uncheck to generate on the cheaper Flex tier, which may take longer to respond."
+                     if HAS_SERVICE_TIERS else
+                     "Service tiers need a newer google-genai release; memes use the standard tier.",
+            )
         generate_memes_btn = st.button("Generate Memes for Selected Rows")
         
         if generate_memes_btn and selected_indices:
             generated_images = []
-            for idx in selected_indices:
-                row = marketing_data.iloc[idx]
-                meme_prompt = f"""
-                "Create a meme using the '{row['meme_template']}' style. 
-                The meme should tell a short, funny, and relatable story targeting {row['target_audience']} on {row['platform']}.  
-
-                Company Background : Complytics.ai, {row['company_background']}  
-                Marketing Message : {row['marketing_message']}  
-                Call to Action to use Complytics.ai : {row['call_to_action']}  
-
-                Theme: {row['theme']}  
-
-                Ensure the meme humor connects with the target audience while subtly highlighting the value of the company. 
-                The final meme should be engaging, visually clear, and suitable for viral social media marketing.
-                Avoid adding any company logo. Dont make spelling mistake"
-                """
-                
-                with st.spinner(f"Generating meme for Row {idx}..."):
-                    try:
-                        saved_files = generate_image_streaming(meme_prompt, f"meme_{idx}")
-                        if saved_files:
-                            generated_images.append({
-                                "row": idx,
-                                "image_path": saved_files[0],
-                                "meme_template": row['meme_template'],
-                                "prompt": row['prompt'],
-                                "company_background": row['company_background'],
-                                "marketing_message": row['marketing_message'],
-                                "call_to_action": row['call_to_action'],
-                                "target_audience": row['target_audience'],
-                                "platform": row['platform'],
-                                "theme": row['theme']
-                            })
-                            st.image(Image.open(saved_files[0]), caption=f"Meme for Row {idx}")
-                    except Exception as e:
-                        st.error(f"Failed for Row {idx}: {e}")
+            records = marketing_data.to_dict(orient="records")
+            prompts = [
+                (MEME_PROMPT_TEMPLATE.format_map(records[idx]), f"meme_{idx}")
+                for idx in selected_indices
+            ]
+            service_tier = None if interactive else "FLEX"
+            if use_batch and len(prompts) > 1:
+                with st.spinner(f"Waiting for batch job with {len(prompts)} meme(s)..."):
+                    results = generate_memes(prompts, use_batch, service_tier)
+            else:
+                # One progress bar for the whole fan-out, advanced as each meme lands
+                progress = st.progress(0.0, text="Generating memes...")
+                results = generate_memes(
+                    prompts,
+                    use_batch,
+                    service_tier,
+                    on_progress=lambda done, total: progress.progress(done / total, text=f"{done}/{total} memes done"),
+                )
+            
+            for idx, (meme_prompt, _), images in zip(selected_indices, prompts, results):
+                if isinstance(images, Exception):
+                    st.error(f"Failed for Row {idx}: {images}")
+                    continue
+                if images:
+                    image_bytes, mime_type = images[0]
+                    generated_images.append(MemeRecord(idx, image_bytes, mime_type, meme_prompt, **records[idx]))
+                    st.image(image_bytes, caption=f"Meme for Row {idx}")
             
             st.session_state.generated_images = generated_images
             st.success(f"✅ Generated {len(generated_images)} memes!")
         
         # Export to Excel
         if "generated_images" in st.session_state and st.button("Export to Excel"):
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "Memes"
+            # Write-only mode streams rows straight into the xlsx instead of holding every cell in memory
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("Memes")
             
             # Headers
             headers = ['Row', 'Meme Template', 'Prompt', 'Company Background', 'Marketing Message', 'Call to Action', 'Target Audience', 'Platform', 'Theme', 'Image']
-            for col, header in enumerate(headers, 1):
-                ws.cell(row=1, column=col, value=header)
+            ws.append(headers)
             
             # Data
             for row_idx, item in enumerate(st.session_state.generated_images, 2):
-                ws.cell(row=row_idx, column=1, value=item['row'])
-                ws.cell(row=row_idx, column=2, value=item['meme_template'])
-                ws.cell(row=row_idx, column=3, value=item['prompt'])
-                ws.cell(row=row_idx, column=4, value=item['company_background'])
-                ws.cell(row=row_idx, column=5, value=item['marketing_message'])
-                ws.cell(row=row_idx, column=6, value=item['call_to_action'])
-                ws.cell(row=row_idx, column=7, value=item['target_audience'])
-                ws.cell(row=row_idx, column=8, value=item['platform'])
-                ws.cell(row=row_idx, column=9, value=item['theme'])
+                ws.append([
+                    item.row,
+                    item.meme_template,
+                    item.prompt,
+                    item.company_background,
+                    item.marketing_message,
+                    item.call_to_action,
+                    item.target_audience,
+                    item.platform,
+                    item.theme,
+                ])
                 
-                # Insert image
-                img = XLImage(item['image_path'])
+                # Insert a downscaled copy; the full-resolution image stays in session_state
+                img = XLImage(thumbnail_png(item.image_bytes))
                 img.width = 200
                 img.height = 200
                 ws.add_image(img, f"J{row_idx}")
@@ -434,6 +1027,14 @@ with tab3:
             wb.save("memes_export.xlsx")
             with open("memes_export.xlsx", "rb") as f:
                 st.download_button("Download Excel", data=f, file_name="memes_export.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        
+        # Release the session's image bytes once they are no longer needed, including
+        # the shared prompt cache's copies (regenerating these rows will call Gemini again)
+        if "generated_images" in st.session_state and st.button("Clear in-memory memes"):
+            prompt_cache.evict_exact(item.meme_prompt for item in st.session_state.generated_images)
+            del st.session_state.generated_images
+            gc.collect()
+            st.success("🧹 Cleared generated memes from memory.")
 
 # Footer
 st.markdown("---")